@@ -0,0 +1,327 @@
+# anonymize_numba.py
+"""
+Caminho JIT (Numba) de anonimização para o modo lote.
+
+Percorre o buffer UTF-8 do texto com uma máquina de estados que reconhece
+e-mails, CPF/CNPJ (formatados ou só dígitos) e sequências longas de dígitos,
+em passagens lineares e sem alocar objetos Python.
+O kernel é compilado com nogil=True (não segura o GIL durante a varredura) e
+cache=True (o código compilado é reaproveitado entre processos).
+
+Numba é opcional: sem ele, NUMBA_AVAILABLE é False e os chamadores devem usar
+o caminho por regex (llm_client.anonymize_text).
+As regras reproduzem as regex, inclusive a classificação Unicode de \\w/\\d
+(limites de palavra e dígitos) em todos os planos. check_anonymize_numba.py
+compara os dois caminhos e deve ser executado após qualquer mudança nas regex.
+"""
+
+import re
+import sys
+
+try:
+    import numpy as np
+    from numba import njit
+    NUMBA_AVAILABLE = True
+except ImportError:  # numba/numpy não instalados: caminho por regex
+    NUMBA_AVAILABLE = False
+
+    def njit(*args, **kwargs):
+        return lambda func: func
+
+_UNICODE_SIZE = sys.maxunicode + 1
+_KIND_PII = 2
+_KIND_NUM = 3
+
+
+def _build_tables():
+    """
+    Tabelas por code point (todo o Unicode), geradas pelo próprio re para
+    reproduzir exatamente as classes usadas nas regex:
+    - word: caracteres de palavra (\\w)
+    - digit: dígitos (\\d)
+    Marca as faixas contíguas encontradas pelo re em vez de testar code point a
+    code point em Python: a importação continua barata.
+    """
+    chars = "".join(map(chr, range(_UNICODE_SIZE)))
+    tables = []
+    for pattern in (r"\w+", r"\d+"):
+        table = np.zeros(_UNICODE_SIZE, dtype=np.uint8)
+        for m in re.finditer(pattern, chars):
+            table[m.start():m.end()] = 1
+        tables.append(table)
+    return tuple(tables)
+
+
+if NUMBA_AVAILABLE:
+    _WORD_TABLE, _DIGIT_TABLE = _build_tables()
+    _EMAIL_TAG = np.frombuffer(b"[EMAIL_REMOVIDO]", dtype=np.uint8)
+    _PII_TAG = np.frombuffer(b"[PII_REMOVIDO]", dtype=np.uint8)
+    _NUM_TAG = np.frombuffer(b"[NUM_REMOVIDO]", dtype=np.uint8)
+
+
+# -------------------------
+# Kernel (compilado por Numba)
+# -------------------------
+@njit(cache=True, nogil=True)
+def _cp_at(buf, i):
+    """Decodifica o code point que começa em buf[i]; retorna (cp, próximo índice)."""
+    b0 = np.int64(buf[i])
+    if b0 < 0x80:
+        return b0, i + 1
+    if b0 < 0xE0:
+        return ((b0 & 0x1F) << 6) | (np.int64(buf[i + 1]) & 0x3F), i + 2
+    if b0 < 0xF0:
+        return (((b0 & 0x0F) << 12) | ((np.int64(buf[i + 1]) & 0x3F) << 6)
+                | (np.int64(buf[i + 2]) & 0x3F)), i + 3
+    return (((b0 & 0x07) << 18) | ((np.int64(buf[i + 1]) & 0x3F) << 12)
+            | ((np.int64(buf[i + 2]) & 0x3F) << 6) | (np.int64(buf[i + 3]) & 0x3F)), i + 4
+
+
+@njit(cache=True, nogil=True)
+def _in_table(cp, table):
+    return table[cp] != 0
+
+
+@njit(cache=True, nogil=True)
+def _is_word_before(buf, i, word_tab):
+    """True se o caractere que termina em buf[i-1] é de palavra (\\w)."""
+    if i == 0:
+        return False
+    j = i - 1
+    while j > 0 and (buf[j] & 0xC0) == 0x80:
+        j -= 1
+    cp, _ = _cp_at(buf, j)
+    return _in_table(cp, word_tab)
+
+
+@njit(cache=True, nogil=True)
+def _is_word_at(buf, i, lim, word_tab):
+    """True se o caractere que começa em buf[i] é de palavra (\\w); `lim` age como fim do texto."""
+    if i >= lim:
+        return False
+    cp, _ = _cp_at(buf, i)
+    return _in_table(cp, word_tab)
+
+
+@njit(cache=True, nogil=True)
+def _is_alnum_ascii(b):
+    # operadores bit a bit: `and`/`or` em um return geram código lento no Numba
+    return (48 <= b <= 57) | (65 <= b <= 90) | (97 <= b <= 122)
+
+
+@njit(cache=True, nogil=True)
+def _is_email_local(b):
+    # [a-zA-Z0-9_.+-]
+    return _is_alnum_ascii(b) | (b == 95) | (b == 46) | (b == 43) | (b == 45)
+
+
+@njit(cache=True, nogil=True)
+def _is_email_label(b):
+    # [a-zA-Z0-9-]
+    return _is_alnum_ascii(b) | (b == 45)
+
+
+@njit(cache=True, nogil=True)
+def _is_email_tail(b):
+    # [a-zA-Z0-9-.]
+    return _is_alnum_ascii(b) | (b == 45) | (b == 46)
+
+
+@njit(cache=True, nogil=True)
+def _match_email_domain(buf, at, n):
+    """Domínio após o '@' em buf[at]: [a-zA-Z0-9-]+\\.[a-zA-Z0-9-.]+ ; retorna o fim ou -1."""
+    k = at + 1
+    while k < n and _is_email_label(buf[k]):
+        k += 1
+    if k == at + 1 or k >= n or buf[k] != 46:
+        return -1
+    k += 1
+    tail = k
+    while k < n and _is_email_tail(buf[k]):
+        k += 1
+    if k == tail:
+        return -1
+    return k
+
+
+@njit(cache=True, nogil=True)
+def _find_emails(buf, n):
+    """
+    Localiza os e-mails (mesma semântica da regex: início mais à esquerda,
+    domínio guloso). Retorna arrays (inícios, fins) e a quantidade.
+    """
+    starts = np.empty(n // 5 + 1, dtype=np.int64)
+    ends = np.empty(n // 5 + 1, dtype=np.int64)
+    count = 0
+    p = 0
+    while p < n:
+        if not _is_email_local(buf[p]):
+            p += 1
+            continue
+        j = p
+        while j < n and _is_email_local(buf[j]):
+            j += 1
+        if j < n and buf[j] == 64:
+            end = _match_email_domain(buf, j, n)
+            if end > 0:
+                starts[count] = p
+                ends[count] = end
+                count += 1
+                p = end
+                continue
+        p = j
+    return starts, ends, count
+
+
+@njit(cache=True, nogil=True)
+def _match_digits(buf, k, lim, count, digit_tab):
+    """Exatamente `count` dígitos (\\d) a partir de k, sem outro dígito em seguida; retorna o fim ou -1."""
+    if k < 0:
+        return -1
+    for _ in range(count):
+        if k >= lim:
+            return -1
+        cp, nxt = _cp_at(buf, k)
+        if not _in_table(cp, digit_tab):
+            return -1
+        k = nxt
+    if k < lim:
+        cp, _ = _cp_at(buf, k)
+        if _in_table(cp, digit_tab):
+            return -1
+    return k
+
+
+@njit(cache=True, nogil=True)
+def _match_sep(buf, k, lim, sep):
+    if k < 0 or k >= lim or buf[k] != sep:
+        return -1
+    return k + 1
+
+
+@njit(cache=True, nogil=True)
+def _match_cpf(buf, i, lim, word_tab, digit_tab):
+    """\\d{3}\\.\\d{3}\\.\\d{3}-\\d{2}\\b a partir de i; retorna o fim ou -1."""
+    k = _match_sep(buf, _match_digits(buf, i, lim, 3, digit_tab), lim, 46)
+    k = _match_sep(buf, _match_digits(buf, k, lim, 3, digit_tab), lim, 46)
+    k = _match_sep(buf, _match_digits(buf, k, lim, 3, digit_tab), lim, 45)
+    k = _match_digits(buf, k, lim, 2, digit_tab)
+    if k < 0 or _is_word_at(buf, k, lim, word_tab):
+        return -1
+    return k
+
+
+@njit(cache=True, nogil=True)
+def _match_cnpj(buf, i, lim, word_tab, digit_tab):
+    """\\d{2}\\.\\d{3}\\.\\d{3}/\\d{4}-\\d{2}\\b a partir de i; retorna o fim ou -1."""
+    k = _match_sep(buf, _match_digits(buf, i, lim, 2, digit_tab), lim, 46)
+    k = _match_sep(buf, _match_digits(buf, k, lim, 3, digit_tab), lim, 46)
+    k = _match_sep(buf, _match_digits(buf, k, lim, 3, digit_tab), lim, 47)
+    k = _match_sep(buf, _match_digits(buf, k, lim, 4, digit_tab), lim, 45)
+    k = _match_digits(buf, k, lim, 2, digit_tab)
+    if k < 0 or _is_word_at(buf, k, lim, word_tab):
+        return -1
+    return k
+
+
+@njit(cache=True, nogil=True)
+def _emit_tag(out, o, tag):
+    for q in range(tag.shape[0]):
+        out[o + q] = tag[q]
+    return o + tag.shape[0]
+
+
+@njit(cache=True, nogil=True)
+def _scan(buf, word_tab, digit_tab, email_tag, pii_tag, num_tag):
+    """
+    Anonimiza o buffer UTF-8.
+    Os e-mails são localizados primeiro (têm prioridade, como na regex); em
+    seguida uma única varredura por code point aplica os padrões de dígitos.
+    Retorna (saída anonimizada, tamanho usado).
+    """
+    n = buf.shape[0]
+    em_starts, em_ends, em_count = _find_emails(buf, n)
+    # pior caso: "a@b.c" (5 bytes) -> "[EMAIL_REMOVIDO]" (16 bytes)
+    out = np.empty(n * 4 + 16, dtype=np.uint8)
+    o = 0
+    ep = 0          # próximo e-mail ainda não emitido
+    skip = 0        # bytes antes de `skip` já foram substituídos por uma tag
+    last_email_end = -1
+
+    i = 0
+    while i < n:
+        # caminho rápido para ASCII (a maior parte do texto)
+        cp = np.int64(buf[i])
+        if cp < 0x80:
+            nxt = i + 1
+        else:
+            cp, nxt = _cp_at(buf, i)
+
+        if ep < em_count and i == em_starts[ep]:
+            o = _emit_tag(out, o, email_tag)
+            skip = em_ends[ep]
+            last_email_end = skip
+            ep += 1
+        elif i >= skip:
+            kind = 0
+            end = -1
+            # padrões de dígitos não atravessam um e-mail (que vira "[EMAIL_REMOVIDO]")
+            lim = em_starts[ep] if ep < em_count else n
+            if (_in_table(cp, digit_tab)
+                    and (i == last_email_end or not _is_word_before(buf, i, word_tab))):
+                end = _match_cpf(buf, i, lim, word_tab, digit_tab)
+                if end < 0:
+                    end = _match_cnpj(buf, i, lim, word_tab, digit_tab)
+                if end > 0:
+                    kind = _KIND_PII
+                else:
+                    j = i
+                    size = 0
+                    while j < lim:
+                        dcp, dnxt = _cp_at(buf, j)
+                        if not _in_table(dcp, digit_tab):
+                            break
+                        j = dnxt
+                        size += 1
+                    if not _is_word_at(buf, j, lim, word_tab):
+                        if size == 11 or size == 14:
+                            kind = _KIND_PII
+                            end = j
+                        elif size >= 6:
+                            kind = _KIND_NUM
+                            end = j
+
+            if kind == _KIND_PII:
+                o = _emit_tag(out, o, pii_tag)
+                skip = end
+            elif kind == _KIND_NUM:
+                o = _emit_tag(out, o, num_tag)
+                skip = end
+            else:
+                for q in range(i, nxt):
+                    out[o] = buf[q]
+                    o += 1
+
+        i = nxt
+
+    return out, o
+
+
+# -------------------------
+# Interface Python
+# -------------------------
+def anonymize_text(text: str) -> str:
+    """Equivalente JIT de llm_client.anonymize_text."""
+    if not isinstance(text, str):
+        return ""
+    if not NUMBA_AVAILABLE:
+        raise RuntimeError("numba não está instalado")
+    buf = np.frombuffer(text.encode("utf-8", "surrogatepass"), dtype=np.uint8)
+    out, size = _scan(buf, _WORD_TABLE, _DIGIT_TABLE, _EMAIL_TAG, _PII_TAG, _NUM_TAG)
+    return out[:size].tobytes().decode("utf-8", "surrogatepass")
+
+
+def warmup() -> None:
+    """Compila o kernel (ou carrega do cache) com um texto curto, fora do caminho da requisição."""
+    if NUMBA_AVAILABLE:
+        anonymize_text("aquecimento teste@exemplo.com 123.456.789-09 1234567")
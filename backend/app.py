@@ -6,21 +6,54 @@ from dotenv import load_dotenv
 # Carregar variáveis ANTES de módulos dependentes
 load_dotenv()
 
+import atexit
+import asyncio
+import multiprocessing
 import tempfile
-from flask import Flask, request, jsonify, send_from_directory
+import threading
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+import orjson
+from flask import Flask, Response, request, jsonify, send_from_directory
+from flask.json.provider import JSONProvider
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
-from pdfminer.high_level import extract_text
-from nlp_utils import preprocess_for_sending, extract_keywords
+from nlp_utils import preprocess_for_sending, extract_keywords, get_encoder
 from llm_client import (
     classify_email,
     generate_response,
+    stream_response,
+    classify_and_respond,
+    submit_classify_batch,
+    get_classify_batch,
+    BatchNotFoundError,
+    close_clients,
+    heuristics_fallback_classify,
+    anonymize_text,
+    MODEL,
     call_llm_for_classify_and_respond  # compatibilidade
 )
 from templates import TEMPLATES
+from pdf_extract import extract_pdf_bytes, extract_pdf_file
+from anonymize_numba import warmup as warmup_anonymize_jit
+
+
+class OrjsonProvider(JSONProvider):
+    """jsonify/get_json via orjson; a resposta já sai em bytes, sem encode extra."""
+
+    def dumps(self, obj, **kwargs):
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS).decode()
+
+    def loads(self, s, **kwargs):
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS),
+                                        mimetype='application/json')
 
 
 app = Flask(__name__, static_folder='../frontend', static_url_path='/')
+app.json = OrjsonProvider(app)
 CORS(app, resources={
     r"/api/*": {
         "origins": [
@@ -31,23 +64,102 @@ CORS(app, resources={
     }
 })
 
+# Compilar (ou carregar do cache) o kernel JIT do modo lote na inicialização,
+# fora do caminho das requisições; no-op se o Numba não estiver instalado
+warmup_anonymize_jit()
+# Carregar o encoder tiktoken (pode baixar o BPE) antes da primeira requisição;
+# se falhar, get_encoder tenta de novo mais tarde
+get_encoder(MODEL)
+
+# Encerrar pools HTTP dos clientes OpenAI junto com o processo
+atexit.register(close_clients)
+
 ALLOWED_EXTENSIONS = {'pdf', 'txt'}
 MAX_SEND_CHARS = int(os.getenv("MAX_EMAIL_CHARS", "12000"))
+MAX_SEND_TOKENS = int(os.getenv("MAX_EMAIL_TOKENS", "0")) or None
+MAX_BATCH_EMAILS = int(os.getenv("MAX_BATCH_EMAILS", "1000"))
+MAX_BATCH_WAIT = float(os.getenv("MAX_BATCH_WAIT", "30"))
+# Processos de PDF por worker do Gunicorn: os núcleos divididos entre os WEB_CONCURRENCY workers
+PDF_WORKERS = (int(os.getenv("PDF_WORKERS", "0"))
+               or max(1, (os.cpu_count() or 1) // int(os.getenv("WEB_CONCURRENCY", "1"))))
+# Tamanho máximo da requisição (uploads); acima disso o Flask responde 413
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_MB", "10")) * 1024 * 1024
+# PDFs até este tamanho vão em memória para o pool; maiores passam por arquivo temporário
+PDF_INLINE_MAX_BYTES = 1024 * 1024
+
+app.config['MAX_CONTENT_LENGTH'] = MAX_UPLOAD_BYTES
+
+# Pool de threads para trabalho de CPU leve (ex.: keywords) que pode correr
+# em paralelo à espera de rede das chamadas ao LLM
+_CPU_POOL = ThreadPoolExecutor(max_workers=4)
+atexit.register(_CPU_POOL.shutdown, wait=False)
+
+# Pool de processos para o pdfminer (Python puro e CPU-bound): o parsing sai
+# da thread da requisição e PDFs concorrentes usam vários núcleos (sem GIL).
+# Criado sob demanda, para não subir processos em quem só envia texto.
+# "forkserver": dar fork direto de um worker com dezenas de threads (requisições,
+# loop do cliente OpenAI) pode herdar locks travados; o forkserver parte de um
+# processo limpo e só importa pdf_extract. ("spawn" onde não há forkserver.)
+_PDF_POOL = None
+_PDF_POOL_LOCK = threading.Lock()
+
+
+def _get_pdf_pool():
+    global _PDF_POOL
+    if _PDF_POOL is None:
+        with _PDF_POOL_LOCK:
+            if _PDF_POOL is None:
+                method = ("forkserver" if "forkserver" in multiprocessing.get_all_start_methods()
+                          else "spawn")
+                context = multiprocessing.get_context(method)
+                if method == "forkserver":
+                    # pdfminer importado uma vez no forkserver, herdado pelos processos
+                    context.set_forkserver_preload(["pdf_extract"])
+                _PDF_POOL = ProcessPoolExecutor(max_workers=PDF_WORKERS, mp_context=context)
+                atexit.register(_PDF_POOL.shutdown, wait=False, cancel_futures=True)
+    return _PDF_POOL
 
 
 def allowed_file(filename):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
 
 
-def extract_text_from_file(tmp_path, filename):
-    if filename.lower().endswith('.pdf'):
-        return extract_text(tmp_path) or ""
-    else:
-        try:
-            with open(tmp_path, 'r', encoding='utf-8', errors='ignore') as f:
-                return f.read()
-        except Exception:
-            return ""
+async def extract_text_from_file(file, filename):
+    # o upload vem do spool do Werkzeug (memória ou disco), limitado por MAX_CONTENT_LENGTH
+    if not filename.lower().endswith('.pdf'):
+        return file.stream.read().decode('utf-8', errors='ignore')
+
+    stream = file.stream
+    stream.seek(0, os.SEEK_END)
+    size = stream.tell()
+    stream.seek(0)
+    if size <= PDF_INLINE_MAX_BYTES:
+        future = _get_pdf_pool().submit(extract_pdf_bytes, stream.read())
+        return await asyncio.wrap_future(future)
+
+    # PDF grande: nem o upload inteiro em RAM nem uma cópia serializada para o pool
+    fd, tmp_path = tempfile.mkstemp(suffix='.pdf')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            file.save(tmp)
+        future = _get_pdf_pool().submit(extract_pdf_file, tmp_path)
+        return await asyncio.wrap_future(future)
+    finally:
+        os.unlink(tmp_path)
+
+
+def wants_event_stream():
+    return request.accept_mimetypes.best == 'text/event-stream'
+
+
+def sse_event(data, event=None):
+    prefix = f"event: {event}\n" if event else ""
+    return f"{prefix}data: {orjson.dumps(data).decode()}\n\n"
+
+
+@app.errorhandler(413)
+def request_too_large(_error):
+    return jsonify({"error": f"Arquivo maior que o limite de {MAX_UPLOAD_BYTES // (1024 * 1024)} MB"}), 413
 
 
 @app.route('/')
@@ -56,7 +168,7 @@ def index():
 
 
 @app.route('/api/process', methods=['POST'])
-def process():
+async def process():
     text = (request.form.get('text') or '').strip()
     file = request.files.get('file')
 
@@ -70,43 +182,87 @@ def process():
         if not allowed_file(filename):
             return jsonify({"error": "Tipo de arquivo não permitido"}), 400
 
-        with tempfile.NamedTemporaryFile(delete=False) as tmp:
-            file.save(tmp.name)
-            file_text = extract_text_from_file(tmp.name, filename)
+        file_text = await extract_text_from_file(file, filename)
 
     # Unir texto + arquivo
     full_text = (text + "\n" + file_text).strip()
     if not full_text:
         return jsonify({"error": "Conteúdo do e-mail vazio após extração"}), 400
 
+    # Minúsculas uma única vez: usadas pelas keywords e pelas heurísticas
+    full_lower = full_text.lower()
+
+    # Keywords em paralelo com as chamadas ao LLM (fora do caminho crítico)
+    kw_future = _CPU_POOL.submit(extract_keywords, full_lower, 6, lowered=True)
+
     # Preprocessamento com corte seguro
-    to_send = preprocess_for_sending(full_text, max_chars=MAX_SEND_CHARS)
+    to_send = preprocess_for_sending(full_text, max_chars=MAX_SEND_CHARS,
+                                     max_tokens=MAX_SEND_TOKENS, model=MODEL)
+    # Anonimização uma única vez; as chamadas ao LLM recebem o texto já anonimizado
+    anon = anonymize_text(to_send)
 
     # ============================================================
-    # NOVO FLUXO — Classificação + Geração independente
+    # STREAMING (Accept: text/event-stream) — classificação primeiro,
+    # depois a resposta sugerida é enviada trecho a trecho via SSE
     # ============================================================
-    try:
-        cls = classify_email(to_send)
+    if wants_event_stream():
+        cls = await classify_email(anon, already_anonymized=True)
         category = cls.get("category", "Improdutivo")
-        confidence = cls.get("confidence", None)
         summary = cls.get("summary", "")
 
-        # Normalização segura
-        if category.capitalize() not in ("Produtivo", "Improdutivo"):
-            category = "Produtivo" if any(k in to_send.lower()
-                    for k in ["solic", "erro", "problema", "atualiza"]) else "Improdutivo"
+        # o gerador não acessa `request` (tudo já foi capturado acima); por isso
+        # dispensa stream_with_context, que não funciona em views async
+        def events():
+            yield sse_event({
+                "category": category,
+                "confidence": cls.get("confidence", None),
+                "summary": summary
+            }, event="meta")
 
-        # gerar resposta
-        gen = generate_response(to_send, category, summary=summary)
-        suggested = gen.get("suggested_response", TEMPLATES.get(category, ""))
+            parts = []
+            for delta in stream_response(anon, category, summary=summary, already_anonymized=True):
+                parts.append(delta)
+                yield sse_event({"delta": delta})
+
+            # resposta completa (com keywords aplicadas) ao final do stream
+            suggested = "".join(parts).strip()
+            if '{keywords}' in suggested:
+                suggested = suggested.replace('{keywords}', ', '.join(kw_future.result()))
+            yield sse_event({"suggested_response": suggested}, event="done")
+
+        return Response(events(), mimetype='text/event-stream',
+                        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"})
+
+    # ============================================================
+    # NOVO FLUXO — Classificação + Geração em uma única chamada
+    # (duas etapas independentes apenas se o JSON vier inválido)
+    # ============================================================
+    try:
+        try:
+            result = await classify_and_respond(anon, already_anonymized=True)
+            category = result["category"]
+            confidence = result["confidence"]
+            summary = result["summary"]
+            suggested = result["suggested_response"]
+
+        except ValueError:
+            cls = await classify_email(anon, already_anonymized=True)
+            category = cls.get("category", "Improdutivo")
+            confidence = cls.get("confidence", None)
+            summary = cls.get("summary", "")
+
+            # Normalização segura
+            if category.capitalize() not in ("Produtivo", "Improdutivo"):
+                category = heuristics_fallback_classify(full_lower, lowered=True)[0]
+
+            # gerar resposta
+            gen = await generate_response(anon, category, summary=summary,
+                                        already_anonymized=True)
+            suggested = gen.get("suggested_response", TEMPLATES.get(category, ""))
 
     except Exception:
         # Fallback — sem LLM
-        fallback_cat = (
-            "Produtivo" if any(k in full_text.lower()
-                               for k in ["erro", "problema", "solicit", "preciso", "atualiza"])
-            else "Improdutivo"
-        )
+        fallback_cat = heuristics_fallback_classify(full_lower, lowered=True)[0]
         return jsonify({
             "category": fallback_cat,
             "suggested_response": TEMPLATES[fallback_cat],
@@ -114,7 +270,7 @@ def process():
         }), 200
 
     # Enriquecer resposta com keywords se houver placeholder
-    keywords = extract_keywords(full_text, top_k=6)
+    keywords = await asyncio.wrap_future(kw_future)
     if '{keywords}' in suggested:
         suggested = suggested.replace('{keywords}', ', '.join(keywords))
 
@@ -129,5 +285,42 @@ def process():
     }), 200
 
 
+@app.route('/api/process_batch', methods=['POST'])
+def process_batch():
+    payload = request.get_json(silent=True) or {}
+    emails = payload.get('emails')
+
+    if not isinstance(emails, list) or not emails:
+        return jsonify({"error": "Envie uma lista 'emails' com ao menos um e-mail"}), 400
+    if len(emails) > MAX_BATCH_EMAILS:
+        return jsonify({"error": f"Máximo de {MAX_BATCH_EMAILS} e-mails por lote"}), 400
+    if not all(isinstance(e, str) and e.strip() for e in emails):
+        return jsonify({"error": "Todos os e-mails do lote devem ser textos não vazios"}), 400
+
+    to_send = [preprocess_for_sending(e, max_chars=MAX_SEND_CHARS,
+                                      max_tokens=MAX_SEND_TOKENS, model=MODEL) for e in emails]
+
+    try:
+        batch = submit_classify_batch(to_send)
+    except Exception:
+        return jsonify({"error": "Não foi possível submeter o lote à OpenAI"}), 502
+
+    return jsonify(batch), 202
+
+
+@app.route('/api/process_batch/<batch_id>', methods=['GET'])
+def process_batch_status(batch_id):
+    wait = min(max(request.args.get('wait', 0.0, type=float), 0.0), MAX_BATCH_WAIT)
+
+    try:
+        batch = get_classify_batch(batch_id, wait=wait)
+    except BatchNotFoundError:
+        return jsonify({"error": "Lote não encontrado"}), 404
+    except Exception:
+        return jsonify({"error": "Não foi possível consultar o lote na OpenAI"}), 502
+
+    return jsonify(batch), 200
+
+
 if __name__ == '__main__':
     app.run(debug=True, port=5000)
@@ -0,0 +1,50 @@
+# check_anonymize_numba.py
+"""
+Verifica que o kernel JIT (anonymize_numba.anonymize_text) produz a mesma
+saída que o caminho por regex (llm_client.anonymize_text).
+
+Executar após qualquer mudança em _EMAIL_RE / _DIGITS_PII_RE ou no kernel:
+    cd backend && python check_anonymize_numba.py [iterações]
+Sai com código 1 se houver divergência (requer numba/numpy instalados).
+"""
+
+import os
+import random
+import sys
+
+os.environ.setdefault("OPENAI_API_KEY", "check")  # llm_client exige a variável na importação
+
+import anonymize_numba
+from llm_client import anonymize_text
+
+# fragmentos que exercitam as bordas das regex: e-mails, CPF/CNPJ, limites de
+# palavra (\b), dígitos Unicode (\d), acentos, caracteres fora do BMP
+_PIECES = [
+    "joao.silva+x@mail.com.br", "a@b.c", "@", "x@", "@y.z", "x_y@d-o.m-a.in",
+    "123.456.789-09", "12.345.678/0001-90", "12345678901", "12345678000190",
+    "1234567", "12345", "٣", "²", "𝟏𝟐𝟑", "𝟎𝟗", "𝐀", "𝑥", "a1",
+    "_", "-", ".", "/", "+", "..", " ", "\n",
+    "é", "Á", "Ç", "ção", "Água", "ÛNICO", "İ", "–", "😀", "abc", "PEDIDO", "status",
+]
+
+
+def main(iterations: int = 30000) -> int:
+    if not anonymize_numba.NUMBA_AVAILABLE:
+        print("numba não está instalado; nada a verificar")
+        return 0
+    rng = random.Random(1)
+    failures = 0
+    for _ in range(iterations):
+        text = "".join(rng.choice(_PIECES) for _ in range(rng.randint(0, 12)))
+        expected = anonymize_text(text)
+        got = anonymize_numba.anonymize_text(text)
+        if expected != got:
+            failures += 1
+            if failures <= 5:
+                print(f"divergência: {text!r}\n  regex: {expected!r}\n  numba: {got!r}")
+    print(f"{iterations} textos, {failures} divergências")
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(int(sys.argv[1]) if len(sys.argv) > 1 else 30000))
@@ -0,0 +1,27 @@
+# gunicorn_conf.py
+"""
+Configuração do Gunicorn para produção:
+
+    gunicorn -c gunicorn_conf.py wsgi:app
+
+Workers gthread: cada requisição fica "estacionada" em uma thread enquanto
+espera a OpenAI, então cada processo atende `threads` chamadas simultâneas.
+gevent não serve aqui: as views async do Flask rodam via asgiref, que recusa
+abrir um event loop por requisição quando outra greenlet da mesma thread já
+tem um loop rodando (RuntimeError sob carga concorrente).
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.getenv('PORT', '5000')}"
+# exportado para os workers: llm_client divide os limites da OpenAI por esse número
+workers = int(os.environ.setdefault("WEB_CONCURRENCY", "4"))
+worker_class = "gthread"
+threads = int(os.getenv("GUNICORN_THREADS", "64"))
+
+# Folga para os retries/backoff das chamadas ao LLM (OPENAI_TIMEOUT por tentativa)
+timeout = max(int(os.getenv("OPENAI_TIMEOUT", "20")) * 4, 60)
+# Maior que o idle timeout típico de load balancers (60s): reaproveita conexões
+keepalive = 75
+
+accesslog = "-"
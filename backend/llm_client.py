@@ -5,20 +5,39 @@ Cliente LLM aprimorado para classificação e geração de resposta.
 Funcionalidades:
 - Carrega OPENAI_API_KEY via dotenv
 - Anonimiza dados sensíveis minimamente (emails, CPFs/CNPJs, sequências longas de dígitos)
-- Separa duas etapas: classify_email(...) e generate_response(...)
-- Validação robusta do JSON retornado pelo modelo (evita falhas por "JSON quebrado")
+- classify_and_respond(...) classifica e responde em uma única chamada (fluxo padrão)
+- Mantém as duas etapas separadas como fallback: classify_email(...) e generate_response(...)
+- Saída em JSON estrito (Structured Outputs / json_schema): sempre parseável direto (orjson)
 - Heurística de fallback rápido se o LLM falhar
-- Retry/backoff para chamadas à API
-- call_llm_for_classify_and_respond(email_text) mantido por compatibilidade (retorna category, suggested_response)
+- Retry/backoff assíncrono para chamadas à API (AsyncOpenAI + asyncio), com jitter
+- Limite de taxa compartilhado (RPM/TPM) entre todas as chamadas do processo
+- Contagem de tokens com tiktoken (limite TPM e corte de e-mails maiores que o contexto)
+- Cache LRU+TTL das respostas do LLM (e-mails repetidos não voltam à API)
+- Classificação em lote via OpenAI Batch API: submit_classify_batch(...) / get_classify_batch(...)
+- call_llm_for_classify_and_respond(email_text) mantido por compatibilidade (síncrono; retorna category, suggested_response)
 """
 
 import os
-import time
 import re
-import json
-import openai
-from typing import Tuple, Optional, Dict, Any
+import time
+import hashlib
+import random
+import asyncio
+import threading
+import httpx
+import orjson
+from typing import Tuple, Optional, Dict, Any, List, Iterator
+from cachetools import TTLCache
+from openai import OpenAI, AsyncOpenAI, NotFoundError
 from dotenv import load_dotenv
+from rate_limiter import RateLimiter
+from nlp_utils import get_encoder
+import anonymize_numba
+
+try:
+    import ahocorasick  # pyahocorasick (requirements.txt)
+except ImportError:  # sem ele, a heurística usa busca de substring por palavra-chave
+    ahocorasick = None
 
 # Carregar .env
 load_dotenv()
@@ -26,11 +45,50 @@ load_dotenv()
 OPENAI_API_KEY = os.getenv("OPENAI_API_KEY")
 MODEL = os.getenv("OPENAI_MODEL", "gpt-4o-mini")
 TIMEOUT = int(os.getenv("OPENAI_TIMEOUT", "20"))
+# Janela de contexto do modelo (prompt + resposta), em tokens
+MODEL_CONTEXT = int(os.getenv("OPENAI_MODEL_CONTEXT", "128000"))
+# Limites de taxa da conta; se ausentes, são descobertos no primeiro uso
+MAX_REQUESTS_PER_MINUTE = os.getenv("OPENAI_MAX_REQUESTS_PER_MINUTE")
+MAX_TOKENS_PER_MINUTE = os.getenv("OPENAI_MAX_TOKENS_PER_MINUTE")
+# Processos que dividem esses limites (workers do Gunicorn; o limitador é por processo)
+RATE_LIMIT_WORKERS = max(1, int(os.getenv("WEB_CONCURRENCY", "1")))
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "10000"))
+LLM_CACHE_TTL = int(os.getenv("LLM_CACHE_TTL", "3600"))
 
 if not OPENAI_API_KEY:
     raise RuntimeError("OPENAI_API_KEY não configurada no ambiente")
 
-openai.api_key = OPENAI_API_KEY
+# Pool de conexões HTTP reaproveitado entre chamadas (evita handshake TCP/TLS por requisição)
+_HTTP_LIMITS = httpx.Limits(max_connections=100, max_keepalive_connections=20)
+
+# Um único cliente AsyncOpenAI (e seu pool httpx) vive em um event loop de fundo,
+# em uma thread própria: o Flask cria um loop novo a cada requisição async, então
+# um cliente preso ao loop da requisição nunca reaproveitaria conexões.
+# As chamadas à API são despachadas para esse loop (_run_on_client_loop).
+_CLIENT_LOOP: Optional[asyncio.AbstractEventLoop] = None
+_CLIENT_LOOP_PID: Optional[int] = None
+_CLIENT_LOOP_LOCK = threading.Lock()
+_ASYNC_CLIENT: Optional[AsyncOpenAI] = None
+# Cliente síncrono para operações administrativas (arquivos/lotes da Batch API)
+_SYNC_CLIENT: Optional[OpenAI] = None
+
+# Batch API
+BATCH_ENDPOINT = "/v1/chat/completions"
+BATCH_COMPLETION_WINDOW = "24h"
+_BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+# metadata gravada por submit_classify_batch: só esses lotes podem ser consultados
+_BATCH_KIND = "classify"
+
+# Limitador de taxa compartilhado (criado sob demanda em _get_rate_limiter)
+_RATE_LIMITER: Optional[RateLimiter] = None
+_RATE_LIMITER_LOCK = threading.Lock()
+# Usados se não houver configuração e a sondagem falhar
+_DEFAULT_MAX_RPM = 500
+_DEFAULT_MAX_TPM = 200_000
+
+# Cache das respostas do LLM (por processo), chaveado pelo hash do texto
+_LLM_CACHE: TTLCache = TTLCache(maxsize=LLM_CACHE_SIZE, ttl=LLM_CACHE_TTL)
+_LLM_CACHE_LOCK = threading.Lock()
 
 # Templates e configurações
 INSTITUTIONAL_TONE = (
@@ -55,6 +113,49 @@ RESPONSE_PROMPT_INSTRUCTIONS = (
     "Retorne apenas o texto da resposta (sem JSON)."
 )
 
+# Classificação + resposta em uma única chamada: mesmas regras, saída em um só JSON
+FUSED_PROMPT_INSTRUCTIONS = (
+    CLASSIFY_PROMPT_INSTRUCTIONS
+    + "Com base na categoria, gere também uma resposta curta (2-6 frases) adequada ao tom institucional.\n"
+    "Se a categoria for 'Produtivo', sugira próximos passos claros e peça informações ausentes se necessário.\n"
+    "Se 'Improdutivo', responda cordialmente sem abrir ticket.\n"
+    "Não inclua instruções internas; escreva a resposta como se fosse enviar ao cliente.\n"
+    "O JSON final deve conter exatamente as chaves: category, confidence, summary, suggested_response "
+    "(suggested_response = apenas o texto da resposta).\n"
+)
+
+# Schemas da saída (Structured Outputs, strict): o modelo só pode responder JSON válido
+CLASSIFY_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "category": {"type": "string", "enum": ["Produtivo", "Improdutivo"]},
+        "confidence": {"type": "number", "minimum": 0, "maximum": 1},
+        "summary": {"type": "string"}
+    },
+    "required": ["category", "confidence", "summary"],
+    "additionalProperties": False
+}
+
+FUSED_SCHEMA = {
+    "type": "object",
+    "properties": {
+        **CLASSIFY_SCHEMA["properties"],
+        "suggested_response": {"type": "string"}
+    },
+    "required": CLASSIFY_SCHEMA["required"] + ["suggested_response"],
+    "additionalProperties": False
+}
+
+CLASSIFY_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "classificacao", "schema": CLASSIFY_SCHEMA, "strict": True}
+}
+
+FUSED_RESPONSE_FORMAT = {
+    "type": "json_schema",
+    "json_schema": {"name": "classificacao_resposta", "schema": FUSED_SCHEMA, "strict": True}
+}
+
 # Fallback templates (quando LLM falhar)
 TEMPLATES = {
     "Produtivo": (
@@ -70,49 +171,230 @@ TEMPLATES = {
 # Heurística simples para fallback
 _PRODUCTIVE_KEYWORDS = [
     "erro", "problema", "solicit", "atualiza", "atualização", "status",
-    "não consigo", "não funciona", "falha", "incidente", "reclama", "ajuda", "suporte"
+    "não consigo", "não funciona", "falha", "incidente", "reclama", "ajuda", "suporte", "preciso"
 ]
 
+# Autômato Aho-Corasick: uma única varredura encontra qualquer palavra-chave
+if ahocorasick is not None:
+    _PRODUCTIVE_AC = ahocorasick.Automaton()
+    for _kw in _PRODUCTIVE_KEYWORDS:
+        _PRODUCTIVE_AC.add_word(_kw, _kw)
+    _PRODUCTIVE_AC.make_automaton()
+else:
+    _PRODUCTIVE_AC = None
+
+# Regex pré-compiladas (anonimização)
+_EMAIL_RE = re.compile(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+")
+# CPF/CNPJ/números longos em uma única varredura. Os padrões não se sobrepõem,
+# então a alternância equivale às substituições em sequência. O e-mail fica
+# em uma passada separada, antes: a tag inserida cria fronteiras (\b) que
+# os padrões de dígitos levam em conta (ex.: "١٢٣٤٥٦x@y.com").
+_DIGITS_PII_RE = re.compile(
+    r"\b(?:"
+    r"(?P<cpf>\d{3}\.\d{3}\.\d{3}-\d{2}|\d{11})"
+    r"|(?P<cnpj>\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}|\d{14})"
+    r"|(?P<num>\d{6,})"
+    r")\b"
+)
+_DIGITS_PII_TAGS = {
+    "cpf": "[PII_REMOVIDO]",
+    "cnpj": "[PII_REMOVIDO]",
+    "num": "[NUM_REMOVIDO]"
+}
+
 # -------------------------
 # Utilitários
 # -------------------------
-def _retry_backoff_call(func, retries=3, base_delay=1.0, *args, **kwargs):
+def _get_client_loop() -> asyncio.AbstractEventLoop:
+    """Retorna o event loop de fundo dos clientes async (criado sob demanda, um por processo)."""
+    global _CLIENT_LOOP, _CLIENT_LOOP_PID, _ASYNC_CLIENT
+    pid = os.getpid()
+    if _CLIENT_LOOP is None or _CLIENT_LOOP_PID != pid:
+        with _CLIENT_LOOP_LOCK:
+            # após um fork, a thread do loop não existe no processo filho: recria
+            if _CLIENT_LOOP is None or _CLIENT_LOOP_PID != pid:
+                loop = asyncio.new_event_loop()
+                threading.Thread(target=loop.run_forever, name="openai-client-loop",
+                                 daemon=True).start()
+                _ASYNC_CLIENT = None
+                _CLIENT_LOOP, _CLIENT_LOOP_PID = loop, pid
+    return _CLIENT_LOOP
+
+async def _run_on_client_loop(coro):
+    """Executa a corrotina no loop de fundo e aguarda o resultado no loop corrente."""
+    return await asyncio.wrap_future(asyncio.run_coroutine_threadsafe(coro, _get_client_loop()))
+
+def _get_client() -> AsyncOpenAI:
+    """
+    Retorna o cliente AsyncOpenAI compartilhado. Só deve ser usado em corrotinas
+    executadas no loop de fundo (via _run_on_client_loop), onde vive seu pool HTTP.
+    """
+    global _ASYNC_CLIENT
+    # criado na própria thread do loop de fundo: sem concorrência na inicialização
+    if _ASYNC_CLIENT is None:
+        _ASYNC_CLIENT = AsyncOpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=TIMEOUT,
+            max_retries=0,  # retries só em _retry_backoff_call (passam pelo limitador)
+            http_client=httpx.AsyncClient(limits=_HTTP_LIMITS, timeout=TIMEOUT)
+        )
+    return _ASYNC_CLIENT
+
+def _get_sync_client() -> OpenAI:
+    """Retorna o cliente OpenAI síncrono compartilhado (criado sob demanda)."""
+    global _SYNC_CLIENT
+    if _SYNC_CLIENT is None:
+        _SYNC_CLIENT = OpenAI(
+            api_key=OPENAI_API_KEY,
+            timeout=TIMEOUT,
+            max_retries=0,  # sem retries ocultos do SDK (o limitador não os veria)
+            http_client=httpx.Client(limits=_HTTP_LIMITS, timeout=TIMEOUT)
+        )
+    return _SYNC_CLIENT
+
+def close_clients() -> None:
+    """Fecha os pools HTTP dos clientes OpenAI (chamado no encerramento do processo)."""
+    global _SYNC_CLIENT, _ASYNC_CLIENT, _CLIENT_LOOP
+    if _SYNC_CLIENT is not None:
+        _SYNC_CLIENT.close()
+        _SYNC_CLIENT = None
+    loop = _CLIENT_LOOP
+    if loop is not None and _CLIENT_LOOP_PID == os.getpid() and loop.is_running():
+        if _ASYNC_CLIENT is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(_ASYNC_CLIENT.close(), loop).result(timeout=5)
+            except Exception:
+                pass
+        loop.call_soon_threadsafe(loop.stop)
+    _ASYNC_CLIENT = None
+    _CLIENT_LOOP = None
+
+async def _probe_rate_limits() -> Tuple[float, float]:
+    """
+    Descobre RPM/TPM da conta com uma requisição de 1 token, lendo os headers
+    x-ratelimit-limit-requests / x-ratelimit-limit-tokens da resposta.
+    Roda no loop de fundo (cliente async compartilhado).
+    """
+    try:
+        raw = await _get_client().chat.completions.with_raw_response.create(
+            model=MODEL,
+            messages=[{"role": "user", "content": "ok"}],
+            max_tokens=1
+        )
+        return (float(raw.headers["x-ratelimit-limit-requests"]),
+                float(raw.headers["x-ratelimit-limit-tokens"]))
+    except Exception:
+        return _DEFAULT_MAX_RPM, _DEFAULT_MAX_TPM
+
+def _configured_rate_limits() -> Optional[Tuple[float, float]]:
+    """Limites vindos do ambiente (OPENAI_MAX_*), se ambos estiverem definidos."""
+    if MAX_REQUESTS_PER_MINUTE and MAX_TOKENS_PER_MINUTE:
+        return float(MAX_REQUESTS_PER_MINUTE), float(MAX_TOKENS_PER_MINUTE)
+    return None
+
+def _set_rate_limiter(rpm: float, tpm: float) -> RateLimiter:
+    """
+    Cria o limitador compartilhado (o ambiente tem precedência sobre a sondagem).
+    rpm/tpm são da conta inteira: cada processo fica com 1/RATE_LIMIT_WORKERS.
+    """
+    global _RATE_LIMITER
+    with _RATE_LIMITER_LOCK:
+        if _RATE_LIMITER is None:
+            _RATE_LIMITER = RateLimiter(float(MAX_REQUESTS_PER_MINUTE or rpm) / RATE_LIMIT_WORKERS,
+                                        float(MAX_TOKENS_PER_MINUTE or tpm) / RATE_LIMIT_WORKERS)
+    return _RATE_LIMITER
+
+async def _get_rate_limiter() -> RateLimiter:
+    """Retorna o limitador compartilhado; a sondagem, se necessária, não bloqueia o event loop."""
+    if _RATE_LIMITER is not None:
+        return _RATE_LIMITER
+    limits = _configured_rate_limits() or await _run_on_client_loop(_probe_rate_limits())
+    return _set_rate_limiter(*limits)
+
+def _get_rate_limiter_sync() -> RateLimiter:
+    """Versão bloqueante de _get_rate_limiter(), para código síncrono (streaming)."""
+    if _RATE_LIMITER is not None:
+        return _RATE_LIMITER
+    limits = _configured_rate_limits() or asyncio.run_coroutine_threadsafe(
+        _probe_rate_limits(), _get_client_loop()).result()
+    return _set_rate_limiter(*limits)
+
+def _cache_key(kind: str, email_text: str, *params: Any) -> Tuple[Any, ...]:
+    """Chave do cache: tipo da chamada, modelo, parâmetros e hash do texto."""
+    text = email_text if isinstance(email_text, str) else ""
+    digest = hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest()
+    return (kind, MODEL, *params, digest)
+
+def _cache_get(key: Tuple[Any, ...]) -> Optional[Dict[str, Any]]:
+    with _LLM_CACHE_LOCK:
+        value = _LLM_CACHE.get(key)
+    return dict(value) if value is not None else None
+
+def _cache_set(key: Tuple[Any, ...], value: Dict[str, Any]) -> None:
+    with _LLM_CACHE_LOCK:
+        _LLM_CACHE[key] = dict(value)
+
+def _count_tokens(messages: List[Dict[str, str]]) -> Optional[int]:
+    """
+    Tokens do prompt pelo encoder do modelo (~4 tokens extras por mensagem no
+    formato de chat). None se o tiktoken não estiver disponível.
+    """
+    enc = get_encoder(MODEL)
+    if enc is None:
+        return None
+    # disallowed_special=(): marcadores como "<|endoftext|>" no e-mail contam como texto comum
+    return sum(len(enc.encode(m["content"], disallowed_special=())) + 4 for m in messages)
+
+def _estimate_tokens(messages: List[Dict[str, str]], max_tokens: int) -> int:
+    """Custo da chamada no TPM: tokens do prompt (ou ~4 caracteres por token) + max_tokens."""
+    prompt_tokens = _count_tokens(messages)
+    if prompt_tokens is None:
+        prompt_tokens = sum(len(m["content"]) for m in messages) // 4
+    return prompt_tokens + max_tokens
+
+async def _retry_backoff_call(func, retries=3, base_delay=1.0, *args, tokens: int = 1, **kwargs):
+    """
+    Executa func respeitando o limitador de taxa compartilhado.
+    Em caso de erro, espera com backoff exponencial + jitter (evita que
+    requisições concorrentes repitam todas ao mesmo tempo).
+    """
+    limiter = await _get_rate_limiter()
     last_exc = None
     for i in range(retries):
+        await limiter.acquire(tokens)
         try:
-            return func(*args, **kwargs)
+            # a chamada roda no loop de fundo, onde está o pool HTTP compartilhado
+            return await _run_on_client_loop(func(*args, **kwargs))
         except Exception as e:
             last_exc = e
-            delay = base_delay * (2 ** i)
-            time.sleep(delay)
+            if i < retries - 1:
+                delay = base_delay * (2 ** i) * random.uniform(0.5, 1.5)
+                await asyncio.sleep(delay)
     raise last_exc
 
-def _extract_json_from_text(text: str) -> Dict[str, Any]:
+def _normalize_category(category: Any) -> Optional[str]:
     """
-    Extrai o JSON mais à direita/primeiro encontrado no texto.
-    Retorna dict ou lança ValueError.
+    Normaliza a categoria retornada pelo modelo.
+    Retorna 'Produtivo'/'Improdutivo' ou None se não for possível decidir.
     """
-    if not text or not isinstance(text, str):
-        raise ValueError("Texto vazio ao extrair JSON")
-
-    # procurar pelo primeiro '{' e o último '}' plausível
-    first = text.find('{')
-    last = text.rfind('}')
-    if first == -1 or last == -1 or last < first:
-        raise ValueError("Nenhum JSON encontrado no texto")
-    json_text = text[first:last+1]
-
-    # tentar corrigir vírgulas finais, aspas ' em vez de ", etc. (tenta uma correção simples)
+    cat_norm = str(category or "").strip().capitalize()
+    if cat_norm in ("Produtivo", "Improdutivo"):
+        return cat_norm
+    cat_norm = cat_norm.lower()
+    if "prod" in cat_norm:
+        return "Produtivo"
+    if "improd" in cat_norm or "não" in cat_norm:
+        return "Improdutivo"
+    return None
+
+def _normalize_confidence(confidence: Any, category: str) -> float:
+    """Garante confidence numérico entre 0 e 1 (com default por categoria)."""
     try:
-        parsed = json.loads(json_text)
-        return parsed
+        confidence = float(confidence)
+        # clamp
+        return max(0.0, min(1.0, confidence))
     except Exception:
-        # tentativas simples de limpeza
-        cleaned = json_text.replace("'", '"')
-        cleaned = re.sub(r",\s*}", "}", cleaned)
-        cleaned = re.sub(r",\s*]", "]", cleaned)
-        parsed = json.loads(cleaned)  # se falhar, propa
-        return parsed
+        return 0.7 if category == "Produtivo" else 0.6
 
 def anonymize_text(text: str) -> str:
     """
@@ -126,92 +408,121 @@ def anonymize_text(text: str) -> str:
         return ""
 
     # emails
-    text = re.sub(r"[a-zA-Z0-9_.+-]+@[a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+", "[EMAIL_REMOVIDO]", text)
+    text = _EMAIL_RE.sub("[EMAIL_REMOVIDO]", text)
 
-    # cpf/cnpj (padrões simples)
-    text = re.sub(r"\b\d{3}\.\d{3}\.\d{3}-\d{2}\b", "[PII_REMOVIDO]", text)
-    text = re.sub(r"\b\d{11}\b", "[PII_REMOVIDO]", text)
-    text = re.sub(r"\b\d{2}\.\d{3}\.\d{3}/\d{4}-\d{2}\b", "[PII_REMOVIDO]", text)
-    text = re.sub(r"\b\d{14}\b", "[PII_REMOVIDO]", text)
+    # cpf/cnpj (padrões simples) e sequências longas de dígitos (6 ou mais)
+    return _DIGITS_PII_RE.sub(lambda m: _DIGITS_PII_TAGS[m.lastgroup], text)
 
-    # sequências longas de dígitos (6 ou mais)
-    text = re.sub(r"\b\d{6,}\b", "[NUM_REMOVIDO]", text)
+def anonymize_many(texts: List[str]) -> List[str]:
+    """
+    Anonimiza vários textos (modo lote). Usa o kernel JIT de anonymize_numba
+    quando o Numba está instalado; caso contrário, o caminho por regex.
+    """
+    if anonymize_numba.NUMBA_AVAILABLE:
+        return [anonymize_numba.anonymize_text(t) for t in texts]
+    return [anonymize_text(t) for t in texts]
 
-    return text
+def find_productive_keyword(text_lower: str) -> Optional[str]:
+    """
+    Retorna a primeira palavra-chave produtiva encontrada no texto (já em
+    minúsculas), ou None. Com pyahocorasick, é uma única passada pelo texto.
+    """
+    if _PRODUCTIVE_AC is not None:
+        for _end, kw in _PRODUCTIVE_AC.iter(text_lower):
+            return kw
+        return None
+    for kw in _PRODUCTIVE_KEYWORDS:
+        if kw in text_lower:
+            return kw
+    return None
 
-def heuristics_fallback_classify(text: str) -> Tuple[str, float, str]:
+def heuristics_fallback_classify(text: str, lowered: bool = False) -> Tuple[str, float, str]:
     """
     Heurística simples: procura por palavras-chave
     Retorna: (category, confidence, summary)
+    lowered=True indica que o texto já está em minúsculas.
     """
-    t = (text or "").lower()
-    for kw in _PRODUCTIVE_KEYWORDS:
-        if kw in t:
-            # confiança moderada
-            return "Produtivo", 0.65, f"Contém palavra-chave indicativa: '{kw}'"
+    text = text or ""
+    kw = find_productive_keyword(text if lowered else text.lower())
+    if kw is not None:
+        # confiança moderada
+        return "Produtivo", 0.65, f"Contém palavra-chave indicativa: '{kw}'"
     # default
     return "Improdutivo", 0.55, "Nenhuma palavra-chave produtiva detectada"
 
 # -------------------------
 # Core: classificação
 # -------------------------
-def classify_email(email_text: str, max_tokens: int = 256, temperature: float = 0.0) -> Dict[str, Any]:
+def _build_classify_messages(text: str) -> List[Dict[str, str]]:
     """
-    Classifica o email e retorna um dict:
-    { "category": "Produtivo"/"Improdutivo", "confidence": float, "summary": "resumo curto" }
+    Monta as mensagens de classificação a partir do texto JÁ anonimizado
+    (também usadas nas linhas da Batch API).
     """
-    text = anonymize_text(email_text)
     system = "Você é um assistente que classifica e resume e-mails para triagem em uma empresa financeira. Responda em Português."
     user = CLASSIFY_PROMPT_INSTRUCTIONS + "\nEmail: '''" + text + "'''\n\nSaída JSON:"
 
-    messages = [
+    return [
         {"role": "system", "content": system},
         {"role": "user", "content": user}
     ]
 
-    def _call():
-        return openai.ChatCompletion.create(
+async def classify_email(email_text: str, max_tokens: int = 256, temperature: float = 0.0,
+                         *, already_anonymized: bool = False) -> Dict[str, Any]:
+    """
+    Classifica o email e retorna um dict:
+    { "category": "Produtivo"/"Improdutivo", "confidence": float, "summary": "resumo curto" }
+    already_anonymized=True: email_text já passou por anonymize_text (não anonimiza de novo).
+    """
+    cache_key = _cache_key("classify", email_text, temperature, max_tokens)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    text = email_text if already_anonymized else anonymize_text(email_text)
+
+    async def _call():
+        return await _get_client().chat.completions.create(
             model=MODEL,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
-            request_timeout=TIMEOUT
+            response_format=CLASSIFY_RESPONSE_FORMAT
         )
 
     try:
-        resp = _retry_backoff_call(_call, retries=3, base_delay=1.0)
-        text_out = resp["choices"][0]["message"]["content"].strip()
-        parsed = _extract_json_from_text(text_out)
+        enc = get_encoder(MODEL)
+        if enc is not None:
+            # pré-contagem: o e-mail que não cabe na janela de contexto é aparado
+            # aqui, em vez de a API recusar a chamada depois de uma ida à rede
+            base_tokens = _count_tokens(_build_classify_messages(""))
+            text_tokens = enc.encode(text, disallowed_special=())
+            budget = max(MODEL_CONTEXT - max_tokens - base_tokens, 0)
+            if len(text_tokens) > budget:
+                text_tokens = text_tokens[:budget]
+                text = enc.decode(text_tokens)
+            tokens = base_tokens + len(text_tokens) + max_tokens
+
+        messages = _build_classify_messages(text)
+        if enc is None:
+            tokens = _estimate_tokens(messages, max_tokens)
+
+        resp = await _retry_backoff_call(_call, retries=3, base_delay=1.0, tokens=tokens)
+        parsed = orjson.loads(resp.choices[0].message.content or "")
 
         # validação e normalização
-        category = str(parsed.get("category", "")).strip()
-        confidence = parsed.get("confidence", None)
-        summary = parsed.get("summary", "") or parsed.get("summary", "")
-
-        # normalizar categoria
-        cat_norm = category.capitalize()
-        if cat_norm not in ("Produtivo", "Improdutivo"):
-            cat_norm = cat_norm.lower()
-            if "prod" in cat_norm:
-                cat_norm = "Produtivo"
-            elif "improd" in cat_norm or "não" in cat_norm:
-                cat_norm = "Improdutivo"
-            else:
-                # heurística se estiver incerto
-                h_cat, h_conf, h_sum = heuristics_fallback_classify(email_text)
-                return {"category": h_cat, "confidence": h_conf, "summary": h_sum}
-
-        # garantir confidence numérico
-        try:
-            confidence = float(confidence)
-            # clamp
-            confidence = max(0.0, min(1.0, confidence))
-        except Exception:
-            confidence = 0.7 if cat_norm == "Produtivo" else 0.6
-
+        cat_norm = _normalize_category(parsed.get("category", ""))
+        if cat_norm is None:
+            # heurística se estiver incerto
+            h_cat, h_conf, h_sum = heuristics_fallback_classify(email_text)
+            return {"category": h_cat, "confidence": h_conf, "summary": h_sum}
+
+        confidence = _normalize_confidence(parsed.get("confidence", None), cat_norm)
+        summary = parsed.get("summary", "")
         summary = str(summary).strip() if summary else ""
 
-        return {"category": cat_norm, "confidence": confidence, "summary": summary}
+        result = {"category": cat_norm, "confidence": confidence, "summary": summary}
+        _cache_set(cache_key, result)
+        return result
 
     except Exception as e:
         # fallback heurístico
@@ -221,13 +532,12 @@ def classify_email(email_text: str, max_tokens: int = 256, temperature: float =
 # -------------------------
 # Core: geração de resposta
 # -------------------------
-def generate_response(email_text: str, category: str, summary: Optional[str] = None,
-                      max_tokens: int = 512, temperature: float = 0.0) -> Dict[str, Any]:
+def _build_response_messages(text: str, category: str,
+                             summary: Optional[str] = None) -> Tuple[List[Dict[str, str]], float]:
     """
-    Gera uma resposta apropriada ao e-mail com base na categoria.
-    Retorna dict: {"suggested_response": str}
+    Monta as mensagens de geração de resposta a partir do texto JÁ anonimizado.
+    Retorna (messages, temperature) de acordo com a categoria.
     """
-    text = anonymize_text(email_text)
     # se improdutivo, usar template curto + LLM opcional para reescrever
     if category == "Improdutivo":
         # pedimos ao LLM para reescrever curtamente (para naturalidade), mas temos fallback
@@ -236,30 +546,10 @@ def generate_response(email_text: str, category: str, summary: Optional[str] = N
             f"O e-mail a seguir parece improdutivo. Gere uma resposta curta e cordial em Português.\n\n"
             f"Email: '''{text}'''\n\nResposta:"
         )
-
-        messages = [
+        return [
             {"role": "system", "content": "Assistente que gera respostas institucionais em Português."},
             {"role": "user", "content": prompt}
-        ]
-
-        def _call():
-            return openai.ChatCompletion.create(
-                model=MODEL,
-                messages=messages,
-                temperature=0.3,
-                max_tokens=max_tokens,
-                request_timeout=TIMEOUT
-            )
-
-        try:
-            resp = _retry_backoff_call(_call, retries=2, base_delay=0.8)
-            reply = resp["choices"][0]["message"]["content"].strip()
-            # segurança: não retornar textos muito longos
-            if len(reply) < 30:
-                raise ValueError("Resposta curta demais")
-            return {"suggested_response": reply}
-        except Exception:
-            return {"suggested_response": TEMPLATES["Improdutivo"]}
+        ], 0.3
 
     # PRODUTIVO
     # montar prompt que inclua summary se houver
@@ -270,29 +560,284 @@ def generate_response(email_text: str, category: str, summary: Optional[str] = N
         f"Resumo do e-mail: \"{summary or ''}\"\n\n"
         f"Email: '''{text}'''\n\nResposta:"
     )
-
-    messages = [
+    return [
         {"role": "system", "content": "Assistente que gera respostas institucionais e seguras em Português."},
         {"role": "user", "content": prompt}
+    ], 0.2
+
+def _validate_reply(reply: str, category: str) -> None:
+    """Lança ValueError se a resposta gerada não for utilizável."""
+    if not reply:
+        raise ValueError("Resposta vazia do LLM")
+    # segurança: respostas improdutivas curtas demais indicam saída truncada/ruim
+    if category == "Improdutivo" and len(reply) < 30:
+        raise ValueError("Resposta curta demais")
+
+async def generate_response(email_text: str, category: str, summary: Optional[str] = None,
+                      max_tokens: int = 512, temperature: float = 0.0,
+                      *, already_anonymized: bool = False) -> Dict[str, Any]:
+    """
+    Gera uma resposta apropriada ao e-mail com base na categoria.
+    Retorna dict: {"suggested_response": str}
+    already_anonymized=True: email_text já passou por anonymize_text.
+    """
+    cache_key = _cache_key("generate", email_text, category, summary or "", max_tokens)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    text = email_text if already_anonymized else anonymize_text(email_text)
+    messages, gen_temperature = _build_response_messages(text, category, summary)
+    # improdutivo: menos retries, já que o template curto é um fallback aceitável
+    retries, base_delay = (2, 0.8) if category == "Improdutivo" else (3, 1.0)
+
+    async def _call():
+        return await _get_client().chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=gen_temperature,
+            max_tokens=max_tokens
+        )
+
+    try:
+        resp = await _retry_backoff_call(_call, retries=retries, base_delay=base_delay,
+                                         tokens=_estimate_tokens(messages, max_tokens))
+        reply = (resp.choices[0].message.content or "").strip()
+        _validate_reply(reply, category)
+        result = {"suggested_response": reply}
+        _cache_set(cache_key, result)
+        return result
+    except Exception:
+        return {"suggested_response": TEMPLATES["Improdutivo" if category == "Improdutivo" else "Produtivo"]}
+
+def stream_response(email_text: str, category: str, summary: Optional[str] = None,
+                    max_tokens: int = 512, *, already_anonymized: bool = False) -> Iterator[str]:
+    """
+    Versão em streaming de generate_response(...): gera os trechos (deltas) da
+    resposta conforme o modelo os produz, para envio via Server-Sent Events.
+    Síncrona (cliente sync), pois o corpo da resposta HTTP é consumido pelo
+    servidor WSGI fora do event loop da rota.
+    Se a chamada falhar antes do primeiro trecho, emite o template da categoria.
+    already_anonymized=True: email_text já passou por anonymize_text.
+    """
+    cache_key = _cache_key("generate", email_text, category, summary or "", max_tokens)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        yield cached["suggested_response"]
+        return
+
+    text = email_text if already_anonymized else anonymize_text(email_text)
+    messages, gen_temperature = _build_response_messages(text, category, summary)
+    parts: List[str] = []
+    try:
+        _get_rate_limiter_sync().acquire_sync(_estimate_tokens(messages, max_tokens))
+        stream = _get_sync_client().chat.completions.create(
+            model=MODEL,
+            messages=messages,
+            temperature=gen_temperature,
+            max_tokens=max_tokens,
+            stream=True
+        )
+        for chunk in stream:
+            delta = chunk.choices[0].delta.content if chunk.choices else None
+            if delta:
+                parts.append(delta)
+                yield delta
+    except Exception:
+        if not parts:
+            yield TEMPLATES["Improdutivo" if category == "Improdutivo" else "Produtivo"]
+        return
+
+    reply = "".join(parts).strip()
+    try:
+        _validate_reply(reply, category)
+    except ValueError:
+        return
+    _cache_set(cache_key, {"suggested_response": reply})
+
+# -------------------------
+# Core: classificação + resposta em uma única chamada
+# -------------------------
+async def classify_and_respond(email_text: str, max_tokens: int = 768, temperature: float = 0.0,
+                               *, already_anonymized: bool = False) -> Dict[str, Any]:
+    """
+    Classifica e gera a resposta em uma única ida ao LLM.
+    Retorna dict: {"category", "confidence", "summary", "suggested_response"}
+    Lança ValueError se o JSON retornado não passar na validação; nesse caso o
+    chamador deve usar o fluxo em duas etapas (classify_email + generate_response).
+    already_anonymized=True: email_text já passou por anonymize_text.
+    temperature=0.0 por padrão: a categoria sai da mesma chamada e deve ser
+    determinística, como em classify_email (a resposta fica menos variada que
+    no fluxo em duas etapas).
+    """
+    cache_key = _cache_key("classify_and_respond", email_text, temperature, max_tokens)
+    cached = _cache_get(cache_key)
+    if cached is not None:
+        return cached
+
+    text = email_text if already_anonymized else anonymize_text(email_text)
+    system = (
+        "Você é um assistente que classifica, resume e responde e-mails para triagem "
+        "em uma empresa financeira. Responda em Português."
+    )
+    user = (
+        f"{INSTITUTIONAL_TONE}\n\n"
+        f"{FUSED_PROMPT_INSTRUCTIONS}\n"
+        f"Email: '''{text}'''\n\nSaída JSON:"
+    )
+
+    messages = [
+        {"role": "system", "content": system},
+        {"role": "user", "content": user}
     ]
 
-    def _call_prod():
-        return openai.ChatCompletion.create(
+    async def _call():
+        return await _get_client().chat.completions.create(
             model=MODEL,
             messages=messages,
-            temperature=0.2,
+            temperature=temperature,
             max_tokens=max_tokens,
-            request_timeout=TIMEOUT
+            response_format=FUSED_RESPONSE_FORMAT
         )
 
+    resp = await _retry_backoff_call(_call, retries=3, base_delay=1.0,
+                                     tokens=_estimate_tokens(messages, max_tokens))
+    parsed = orjson.loads(resp.choices[0].message.content or "")
+
+    category = _normalize_category(parsed.get("category", ""))
+    if category is None:
+        raise ValueError("Categoria inválida no JSON do LLM")
+
+    suggested = str(parsed.get("suggested_response") or "").strip()
+    if not suggested:
+        raise ValueError("suggested_response ausente no JSON do LLM")
+
+    summary = parsed.get("summary", "")
+    result = {
+        "category": category,
+        "confidence": _normalize_confidence(parsed.get("confidence", None), category),
+        "summary": str(summary).strip() if summary else "",
+        "suggested_response": suggested
+    }
+    _cache_set(cache_key, result)
+    return result
+
+# -------------------------
+# Classificação em lote (OpenAI Batch API)
+# -------------------------
+class BatchNotFoundError(LookupError):
+    """Lote inexistente ou não criado por submit_classify_batch(...)."""
+
+def submit_classify_batch(emails: List[str], max_tokens: int = 256, temperature: float = 0.0) -> Dict[str, Any]:
+    """
+    Submete a classificação de vários e-mails à Batch API (mais barata, sem
+    limite de taxa por requisição). Retorna {"id": batch_id, "status": ...}
+    imediatamente; os resultados são obtidos com get_classify_batch(batch_id).
+    O custom_id de cada linha é o índice do e-mail na lista.
+    """
+    lines = []
+    for i, text in enumerate(anonymize_many(emails)):
+        lines.append(orjson.dumps({
+            "custom_id": str(i),
+            "method": "POST",
+            "url": BATCH_ENDPOINT,
+            "body": {
+                "model": MODEL,
+                "messages": _build_classify_messages(text),
+                "temperature": temperature,
+                "max_tokens": max_tokens,
+                "response_format": CLASSIFY_RESPONSE_FORMAT
+            }
+        }))
+    payload = b"\n".join(lines) + b"\n"
+
+    client = _get_sync_client()
+    batch_file = client.files.create(file=("batch.jsonl", payload), purpose="batch")
+    batch = client.batches.create(
+        input_file_id=batch_file.id,
+        endpoint=BATCH_ENDPOINT,
+        completion_window=BATCH_COMPLETION_WINDOW,
+        metadata={"kind": _BATCH_KIND, "size": str(len(emails))}
+    )
+    return {"id": batch.id, "status": batch.status}
+
+def _parse_batch_output_line(line: str) -> Tuple[int, Dict[str, Any]]:
+    """Converte uma linha do arquivo de saída do lote em (índice, resultado)."""
+    item = orjson.loads(line)
+    index = int(item["custom_id"])
+    response = item.get("response") or {}
+    if item.get("error") or response.get("status_code") != 200:
+        error = item.get("error") or (response.get("body") or {}).get("error") or {}
+        return index, {"error": error.get("message", "Falha na requisição do lote")}
+
     try:
-        resp = _retry_backoff_call(_call_prod, retries=3, base_delay=1.0)
-        reply = resp["choices"][0]["message"]["content"].strip()
-        if not reply:
-            raise ValueError("Resposta vazia do LLM")
-        return {"suggested_response": reply}
+        parsed = orjson.loads(response["body"]["choices"][0]["message"]["content"] or "")
     except Exception:
-        return {"suggested_response": TEMPLATES["Produtivo"]}
+        return index, {"error": "JSON inválido retornado pelo modelo"}
+
+    category = _normalize_category(parsed.get("category", ""))
+    if category is None:
+        return index, {"error": "Categoria inválida retornada pelo modelo"}
+
+    summary = parsed.get("summary", "")
+    return index, {
+        "category": category,
+        "confidence": _normalize_confidence(parsed.get("confidence", None), category),
+        "summary": str(summary).strip() if summary else ""
+    }
+
+def get_classify_batch(batch_id: str, wait: float = 0.0, base_delay: float = 1.0,
+                       max_delay: float = 30.0) -> Dict[str, Any]:
+    """
+    Consulta um lote submetido por submit_classify_batch(...).
+    Se wait > 0, faz polling com backoff exponencial por até `wait` segundos.
+    Retorna {"id", "status", "request_counts"} e, quando concluído,
+    "results": lista na mesma ordem dos e-mails enviados.
+    Lança BatchNotFoundError se o lote não existir ou não for de classificação
+    (outros lotes da organização não são expostos).
+    """
+    client = _get_sync_client()
+    deadline = time.monotonic() + max(0.0, wait)
+    delay = base_delay
+    try:
+        batch = client.batches.retrieve(batch_id)
+    except NotFoundError:
+        raise BatchNotFoundError(batch_id)
+    if (batch.metadata or {}).get("kind") != _BATCH_KIND:
+        raise BatchNotFoundError(batch_id)
+    while batch.status not in _BATCH_TERMINAL_STATUSES:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            break
+        time.sleep(min(delay, remaining))
+        delay = min(delay * 2, max_delay)
+        batch = client.batches.retrieve(batch_id)
+
+    counts = batch.request_counts
+    out: Dict[str, Any] = {
+        "id": batch.id,
+        "status": batch.status,
+        "request_counts": {
+            "total": counts.total if counts else 0,
+            "completed": counts.completed if counts else 0,
+            "failed": counts.failed if counts else 0
+        }
+    }
+    if batch.status != "completed":
+        return out
+
+    results: Dict[int, Dict[str, Any]] = {}
+    for file_id in (batch.output_file_id, batch.error_file_id):
+        if not file_id:
+            continue
+        for line in client.files.content(file_id).text.splitlines():
+            if line.strip():
+                index, result = _parse_batch_output_line(line)
+                results[index] = result
+
+    total = out["request_counts"]["total"] or (max(results) + 1 if results else 0)
+    out["results"] = [results.get(i, {"error": "Resultado ausente no lote"}) for i in range(total)]
+    return out
 
 # -------------------------
 # Função compatibilidade antiga (interface simples)
@@ -301,18 +846,28 @@ def call_llm_for_classify_and_respond(email_text: str) -> Tuple[str, str]:
     """
     Função compatível com versões anteriores.
     Retorna (category, suggested_response).
-    Internamente usa classify_email(...) e generate_response(...).
+    Internamente usa classify_and_respond(...) em um event loop próprio, com
+    classify_email(...) + generate_response(...) como fallback.
     """
-    # classificar
-    cls = classify_email(email_text)
-    category = cls.get("category", "Improdutivo")
-    summary = cls.get("summary", "")
+    async def _run():
+        try:
+            result = await classify_and_respond(email_text)
+            return result["category"], result["suggested_response"]
+        except Exception:
+            pass
+
+        # classificar
+        cls = await classify_email(email_text)
+        category = cls.get("category", "Improdutivo")
+        summary = cls.get("summary", "")
+
+        # gerar resposta
+        gen = await generate_response(email_text, category, summary=summary)
+        suggested = gen.get("suggested_response", TEMPLATES.get(category, ""))
 
-    # gerar resposta
-    gen = generate_response(email_text, category, summary=summary)
-    suggested = gen.get("suggested_response", TEMPLATES.get(category, ""))
+        return category, suggested
 
-    return category, suggested
+    return asyncio.run(_run())
 
 # -------------------------
 # Exportar utilitários (opcionais)
@@ -320,6 +875,14 @@ def call_llm_for_classify_and_respond(email_text: str) -> Tuple[str, str]:
 __all__ = [
     "classify_email",
     "generate_response",
+    "stream_response",
+    "classify_and_respond",
+    "submit_classify_batch",
+    "get_classify_batch",
+    "BatchNotFoundError",
+    "close_clients",
     "call_llm_for_classify_and_respond",
-    "anonymize_text"
+    "anonymize_text",
+    "anonymize_many",
+    "heuristics_fallback_classify"
 ]
@@ -1,33 +1,116 @@
+import logging
 import re
+import threading
+import time
+from typing import Optional
+
+logger = logging.getLogger(__name__)
+
+# Regex pré-compilada
+# palavras alfabéticas com 4+ letras (já descarta números, pontuação e palavras curtas)
+_TOKEN_RE = re.compile(r"[a-zA-ZÀ-ú]{4,}")
+
+_STOPWORDS = frozenset({
+    "de", "da", "do", "para", "por", "com", "uma", "um", "em", "e", "o", "a", "que",
+    "na", "no", "nos", "nas", "pois", "mas", "ou", "se", "onde", "como",
+    "tem", "têm", "ter", "ser"
+})
 
 def clean_text(text: str) -> str:
     if not isinstance(text, str):
         return ""
-    text = text.replace("\r", " ").replace("\n", " ")
-    text = re.sub(r"\s+", " ", text)
-    return text.strip()
+    # split() sem argumentos já quebra em qualquer espaço Unicode (inclui \r, \n,
+    # \t, \v, \f) e descarta as pontas: colapso + strip em uma passada em C
+    return " ".join(text.split())
+
+# Encoders já carregados, por modelo. Falhas não são memorizadas: o tiktoken
+# baixa o arquivo BPE no primeiro uso e um erro de rede passageiro não pode
+# desligar os limites em tokens até o processo reiniciar.
+_ENCODERS = {}
+_ENCODERS_LOCK = threading.Lock()
+_ENCODER_RETRY_INTERVAL = 60.0
+_encoder_failed_at = {}
 
-def preprocess_for_sending(text: str, max_chars: int = 20000) -> str:
+def get_encoder(model: str):
+    """
+    Encoder tiktoken do modelo (carregado uma vez por processo).
+    Retorna None se o tiktoken não estiver instalado ou o encoding não puder
+    ser carregado; nesse caso, quem chama deve seguir só com limites em caracteres.
+    Após uma falha, nova tentativa só depois de _ENCODER_RETRY_INTERVAL segundos.
+    """
+    enc = _ENCODERS.get(model)
+    if enc is not None:
+        return enc
+    try:
+        import tiktoken
+    except ImportError:
+        return None
+    with _ENCODERS_LOCK:
+        enc = _ENCODERS.get(model)
+        if enc is not None:
+            return enc
+        failed_at = _encoder_failed_at.get(model)
+        if failed_at is not None and time.monotonic() - failed_at < _ENCODER_RETRY_INTERVAL:
+            return None
+        try:
+            try:
+                enc = tiktoken.encoding_for_model(model)
+            except KeyError:
+                # modelo desconhecido pela versão instalada: encoding dos modelos atuais
+                enc = tiktoken.get_encoding("o200k_base")
+        except Exception as exc:
+            _encoder_failed_at[model] = time.monotonic()
+            logger.warning("encoder tiktoken indisponível para %s (%s); usando só limites em caracteres",
+                           model, exc)
+            return None
+        _encoder_failed_at.pop(model, None)
+        _ENCODERS[model] = enc
+        return enc
+
+def _cut_at_boundary(text: str, limit: int) -> str:
+    """Corta em até `limit` caracteres, no fim de frase ou de palavra mais próximo."""
+    # limit + 1: um ". " ou espaço logo após o limite ainda permite cortar em `limit`
+    cut = text.rfind(". ", 0, limit + 1)
+    if cut >= limit * 0.8:
+        return text[:cut + 1]
+    cut = text.rfind(" ", 0, limit + 1)
+    if cut <= 0:
+        # sem espaço algum (ex.: token gigante): corte seco
+        cut = limit
+    return text[:cut]
+
+def preprocess_for_sending(text: str, max_chars: int = 20000,
+                           max_tokens: Optional[int] = None, model: Optional[str] = None) -> str:
     text = clean_text(text)
+    truncated = False
     if len(text) > max_chars:
-        return text[:max_chars] + "\n\n[...TRUNCADO]"
+        text = _cut_at_boundary(text, max_chars)
+        truncated = True
+
+    # limite real em tokens (opcional, requer tiktoken)
+    if max_tokens and model:
+        enc = get_encoder(model)
+        if enc is not None:
+            tokens = enc.encode(text, disallowed_special=())
+            if len(tokens) > max_tokens:
+                prefix = enc.decode(tokens[:max_tokens])
+                text = _cut_at_boundary(text, len(prefix))
+                truncated = True
+
+    if truncated:
+        return text + "\n\n[...TRUNCADO]"
     return text
 
-def extract_keywords(text: str, top_k: int = 10):
-    text = clean_text(text.lower())
-    # remove números, pontuação e stopwords básicas
-    words = re.sub(r"[^a-zA-ZÀ-ú ]", " ", text).split()
-    stopwords = {"de","da","do","para","por","com","uma","um","em","e","o","a","que",
-                 "na","no","nos","nas","pois","mas","ou","se","onde","como",
-                 "tem","têm","ter","ser"}
-    keywords = [w for w in words if w not in stopwords and len(w) > 3]
-    # mantém ordem e remove duplicados
-    seen = set()
-    out = []
-    for w in keywords:
-        if w not in seen:
-            out.append(w)
-            seen.add(w)
-        if len(out) >= top_k:
+def extract_keywords(text: str, top_k: int = 10, lowered: bool = False):
+    # uma única varredura: tokens alfabéticos, sem stopwords, na ordem de aparição
+    # (dict preserva a ordem de inserção e remove duplicados)
+    # lowered=True: o chamador já passou o texto em minúsculas (evita outra cópia)
+    seen = {}
+    for m in _TOKEN_RE.finditer(text if lowered else text.lower()):
+        w = m.group()
+        if w in _STOPWORDS or w in seen:
+            continue
+        seen[w] = None
+        if len(seen) >= top_k:
             break
-    return out
+    return list(seen)
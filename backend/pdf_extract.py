@@ -0,0 +1,22 @@
+# pdf_extract.py
+"""
+Extração de texto de PDF executada nos processos do pool de app.py.
+
+Fica em um módulo próprio, só com o pdfminer: com o método de início "spawn"
+(ou "forkserver") o processo filho importa o módulo da função submetida, e
+importar app.py recriaria o app Flask, os pools e o cliente da OpenAI.
+"""
+
+import io
+
+from pdfminer.high_level import extract_text
+
+
+def extract_pdf_bytes(data: bytes) -> str:
+    # PDFs pequenos: bytes são picklable, o upload do Werkzeug não
+    return extract_text(io.BytesIO(data)) or ""
+
+
+def extract_pdf_file(path: str) -> str:
+    # PDFs grandes: só o caminho atravessa para o processo do pool
+    return extract_text(path) or ""
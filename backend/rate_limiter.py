@@ -0,0 +1,69 @@
+# rate_limiter.py
+"""
+Limitador de taxa compartilhado para chamadas à OpenAI.
+
+Dois "token buckets" — requisições por minuto (RPM) e tokens por minuto (TPM) —
+reabastecidos continuamente conforme o tempo passa. Todas as chamadas do
+processo passam pelo mesmo limitador, mantendo o serviço no teto do limite
+da conta sem estourá-lo (evita rajadas de 429 e retries sincronizados).
+
+É seguro entre threads e entre event loops (o estado fica sob threading.Lock),
+então pode ser usado tanto pelas rotas async quanto por código síncrono.
+"""
+
+import time
+import asyncio
+import threading
+
+
+class RateLimiter:
+    """Token bucket duplo: max_rpm requisições e max_tpm tokens por minuto."""
+
+    def __init__(self, max_rpm: float, max_tpm: float):
+        if max_rpm <= 0 or max_tpm <= 0:
+            raise ValueError("max_rpm e max_tpm devem ser positivos")
+        self.max_rpm = float(max_rpm)
+        self.max_tpm = float(max_tpm)
+        self._requests = self.max_rpm
+        self._tokens = self.max_tpm
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _reserve(self, tokens: int) -> float:
+        """
+        Tenta consumir 1 requisição + `tokens` tokens.
+        Retorna 0.0 se conseguiu, ou quantos segundos esperar antes de tentar de novo.
+        """
+        # um pedido maior que o balde inteiro nunca caberia; limita ao máximo
+        tokens = min(max(int(tokens), 1), self.max_tpm)
+        with self._lock:
+            now = time.monotonic()
+            elapsed = now - self._last
+            self._last = now
+            self._requests = min(self.max_rpm, self._requests + elapsed * self.max_rpm / 60.0)
+            self._tokens = min(self.max_tpm, self._tokens + elapsed * self.max_tpm / 60.0)
+
+            if self._requests >= 1 and self._tokens >= tokens:
+                self._requests -= 1
+                self._tokens -= tokens
+                return 0.0
+
+            wait_requests = max(0.0, 1 - self._requests) * 60.0 / self.max_rpm
+            wait_tokens = max(0.0, tokens - self._tokens) * 60.0 / self.max_tpm
+            return max(wait_requests, wait_tokens)
+
+    async def acquire(self, tokens: int = 1) -> None:
+        """Aguarda (sem bloquear o event loop) até haver capacidade para a chamada."""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            await asyncio.sleep(wait)
+
+    def acquire_sync(self, tokens: int = 1) -> None:
+        """Versão bloqueante de acquire(), para código síncrono."""
+        while True:
+            wait = self._reserve(tokens)
+            if wait <= 0:
+                return
+            time.sleep(wait)
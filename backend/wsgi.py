@@ -0,0 +1,10 @@
+# wsgi.py
+"""
+Entrypoint WSGI de produção (Gunicorn):
+
+    gunicorn -c gunicorn_conf.py wsgi:app
+"""
+
+from app import app
+
+__all__ = ["app"]